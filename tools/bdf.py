@@ -5,55 +5,107 @@ Copyright (c) 2019 Paolo Jovon <paolo.jovon@gmail.com>
 Released under the 3-clause BSD license (see LICENSE)
 """
 
-import os
-import sys
-import re
-from typing import TextIO, List, Iterable, Any, Callable
+from typing import BinaryIO, List, Tuple, Iterable, Any
 
 from font import row_width, BBox
 
-def bdf_width(width: int) -> int:
-    """Calculates the width in bits of each row in the BDF from the actual witdth of a character in pixels."""
-    # NOTE: Lines in BDF BITMAPs are always stored in multiples of 8 bits
-    # (https://stackoverflow.com/a/37944252)
-    return -((-width) // 8) * 8
+bdf_width = row_width
+"""Calculates the width in bits of each row in the BDF from the actual witdth of a character in pixels.
+(Output font bitmaps use the same row layout as BDF ones, see `font.row_width()`)."""
 
+TEXT_ENCODING = 'utf-8'
+"""The encoding of text (property values...) in BDF files, which are otherwise parsed as bytes."""
 
-def nextline(stream: TextIO) -> str:
-    """Returns the next non-whitespace line in `stream` (stripped) or an empty line on EOF."""
-    line = stream.readline()
-    while line.isspace() or line.startswith('COMMENT'):
-        line = stream.readline()
-    return line.strip()
+
+def _text(line: bytes) -> str:
+    return line.decode(TEXT_ENCODING)
+
+
+class LineCursor:
+    """A cursor over the lines of a BDF file, which is read in memory all at once."""
+
+    def __init__(self, lines: List[bytes]):
+        self.lines = lines
+        """The non-whitespace, non-COMMENT lines in the file (stripped)."""
+        self.i = 0
+        """The index of the next line to read."""
+
+    @staticmethod
+    def from_stream(stream: BinaryIO) -> 'LineCursor':
+        """Reads the whole of `stream` (opened in binary mode) and returns a cursor to its first line."""
+        # Filtering the whole file in one go is faster than doing it line-by-line in `nextline()`
+        lines = [line for line in map(bytes.strip, stream.read().splitlines())
+                 if line and not line.startswith(b'COMMENT')]
+        return LineCursor(lines)
+
+
+def nextline(cursor: LineCursor) -> bytes:
+    """Returns the next non-whitespace line at `cursor` (stripped) or an empty line on EOF."""
+    if cursor.i >= len(cursor.lines):
+        return b''
+    cursor.i += 1
+    return cursor.lines[cursor.i - 1]
+
+
+_WHITESPACE = b' \t\r\n\v\f'
+"""All whitespace characters, to be deleted from lines via `bytes.translate()`."""
+
+
+LINE_EOF, LINE_START, LINE_END, LINE_BITMAP, LINE_KV = range(5)
+"""Kinds of BDF lines, as returned by `classify()`."""
+
+
+def classify(line: bytes) -> Tuple[int, bytes, bytes]:
+    """Classifies a line as returned by `nextline()`, returning `(kind, keyword, rest of the line)`."""
+    if not line:
+        return LINE_EOF, b'', b''
+
+    keyword, *rest = line.split(maxsplit=1)
+    rest = rest[0] if rest else b''
+    if keyword == b'BITMAP':
+        return LINE_BITMAP, keyword, rest
+    elif keyword.startswith(b'START'):
+        return LINE_START, keyword, rest
+    elif keyword.startswith(b'END'):
+        return LINE_END, keyword, rest
+    else:
+        return LINE_KV, keyword, rest
 
 
 class BdfBitmap:
-    def __init__(self, width: int, height: int, data: Iterable[int] = []):
-        self.data = list(data)
+    def __init__(self, width: int, height: int, data: bytes = b'', bdf_width: int = None):
+        self.data = bytearray(data)
+        """The bitmap's rows, `bdf_width // 8` bytes each, top-to-bottom."""
         self.width = int(width)
-        self.bdf_width = row_width(self.width)
+        self.bdf_width = int(bdf_width) if bdf_width is not None else row_width(self.width)
         self.height = int(height)
 
     @staticmethod
-    def parse_from(stream: TextIO, width: int, height: int, first_line: str = None) -> 'BdfBitmap':
-        """Parses a BDF bitmap from the given stream, given its expected width and height(in pixels).
-        If `first_line` is present, uses it instead of fetching a first line from the stream.
+    def parse_from(cursor: LineCursor, width: int, height: int, first_line: bytes = None,
+                   bdf_width: int = None) -> 'BdfBitmap':
+        """Parses a BDF bitmap at the given cursor, given its expected width and height(in pixels).
+        If `first_line` is present, uses it instead of fetching a first line from the cursor.
+        If `bdf_width` is present, it is used as the (precomputed) `bdf_width(width)`.
         """
-        first_line = first_line if first_line is not None else nextline(stream)
-        if not first_line.startswith('BITMAP'):
-            raise SyntaxError(f'Expected BITMAP but found {first_line}')
-
-        bitmap = BdfBitmap(width, height)
-
-        bits_read = 0
-        bits_to_read = bitmap.bdf_width * bitmap.height
-        while bits_read < bits_to_read:
-            line_hex = ''.join(ch for ch in nextline(
-                stream) if not ch.isspace())
+        first_line = first_line if first_line is not None else nextline(cursor)
+        if not first_line.startswith(b'BITMAP'):
+            raise SyntaxError(f'Expected BITMAP but found {_text(first_line)}')
+
+        bitmap = BdfBitmap(width, height, bdf_width=bdf_width)
+
+        # The size of the bitmap is known in advance (each of its rows is on its own line),
+        # so fetch all of its rows and decode them in one go
+        rows = cursor.lines[cursor.i:cursor.i + bitmap.height]
+        cursor.i += len(rows)
+        bitmap_hex = b''.join(rows).translate(None, _WHITESPACE)
+        if len(bitmap_hex) * 4 != bitmap.bdf_width * bitmap.height:
+            raise SyntaxError(
+                f'Expected {bitmap.height} rows of {bitmap.bdf_width} bits in BITMAP, got {rows}')
 
-            for col in range(0, len(line_hex), 2):
-                bitmap.data.append(int(line_hex[col:col+2], 16))
-                bits_read += 8
+        try:
+            bitmap.data = bytearray.fromhex(bitmap_hex.decode('ascii'))
+        except ValueError:
+            raise SyntaxError(f'Invalid hex data in BITMAP: {rows}')
 
         return bitmap
 
@@ -61,35 +113,46 @@ class BdfBitmap:
         return f'BdfBitmap({self.width}x{self.height})'
 
 
+def try_convert_int(value: bytes) -> Any:
+    """Returns `value` as an int if it is a (possibly negative) decimal number, or `value` unchanged otherwise."""
+    digits = value[1:] if value[:1] == b'-' else value
+    return int(value) if digits.isdigit() else value
+
+
 class BdfProperty(tuple):
     """The value of a BDF property as a tuple of ints/strings."""
 
-    VALUE_RE = re.compile(
-        r'\s*(?:(?P<int>-?\d+)|(?P<quoted>"[^"]*")|(?P<unquoted>.+))')
-
-    def __new__(cls, values_str: str):
-        """Inits a BDF property value given the string representing it in the BDF file.
+    def __new__(cls, values_str: bytes):
+        """Inits a BDF property value given the bytes representing it in the BDF file.
         Value(s) are parsed as either ints or strings."""
         return tuple.__new__(cls, cls._parse_value(values_str))
 
     @classmethod
-    def _parse_value(cls, value_str: str) -> Any:
+    def _parse_value(cls, value_str: bytes) -> List[Any]:
         values = []
-        for match in cls.VALUE_RE.finditer(value_str):
-            if not match:
-                raise SyntaxError(
-                    f'Expected int or string value, got {repr(value_str)}')
-
-            integer, quoted, unquoted = match.groups()
-            if integer is not None:
-                value = int(integer)
-            elif quoted is not None:
-                value = quoted[1:-1]
+        rest = value_str.lstrip()
+        while rest:
+            if rest.startswith(b'"'):
+                # "<quoted string>"
+                end = rest.find(b'"', 1)
+                if end >= 0:
+                    values.append(_text(rest[1:end]))
+                    rest = rest[end + 1:].lstrip()
+                    continue
             else:
-                value = unquoted
-            values.append(value)
+                # <int>
+                token, *tail = rest.split(maxsplit=1)
+                value = try_convert_int(token)
+                if isinstance(value, int):
+                    values.append(value)
+                    rest = tail[0] if tail else b''
+                    continue
 
-        return tuple(values)
+            # <unquoted string> (always spans until the end of the line)
+            values.append(_text(rest))
+            break
+
+        return values
 
 
 class BdfRecord:
@@ -102,61 +165,81 @@ class BdfRecord:
         """A mapping of `field -> <BdfProperty(field, args...) or BdfBitmap where field = 'BITMAP' > ."""
         self.children = []
         """A list of `BdfRecord`s that are nested into this one."""
+        self.encoding = None
+        """The ENCODING of the character, for CHAR records (`None` otherwise)."""
 
     @staticmethod
-    def parse_from(stream: TextIO, expected_type: str = None, first_line: str = None) -> 'BdfRecord':
-        """Parses a BDF record from the given stream.
+    def _from_start_line(line: bytes) -> 'BdfRecord':
+        start_tag, *args = _text(line).split()
+        return BdfRecord(start_tag[len('START'):], args)
+
+    @staticmethod
+    def parse_from(cursor: LineCursor, expected_type: str = None, first_line: bytes = None) -> 'BdfRecord':
+        """Parses a BDF record (and all records nested into it) at the given cursor.
         If `expected_type` is present, throws an exception if the record is not of the given type.
-        If `first_line` is present, uses it instead of fetching a first line from the stream.
+        If `first_line` is present, uses it instead of fetching a first line from the cursor.
         """
-        first_line = first_line if first_line is not None else nextline(stream)
+        first_line = first_line if first_line is not None else nextline(cursor)
 
         expected_start_tag = 'START' + expected_type if expected_type else ''
-        if not first_line.startswith(expected_start_tag):
+        if not first_line.startswith(expected_start_tag.encode()):
             raise SyntaxError(
-                f'Expected {expected_start_tag} but found {first_line}')
-
-        this_start_tag, *this_args = first_line.split()
-        record = BdfRecord(this_start_tag[len('START'):], this_args)
-
-        def add_record_item(key, item):
-            if key in record.items:
-                raise SyntaxError(f'Repeated {key} in {record.type}')
+                f'Expected {expected_start_tag} but found {_text(first_line)}')
+
+        root = BdfRecord._from_start_line(first_line)
+        stack = [root]  # (records that are still open, innermost last)
+        font_width = None  # (`(width, bdf_width(width))` of the FONTBOUNDINGBOX, once found)
+
+        while stack:
+            record = stack[-1]
+            line = nextline(cursor)
+            kind, key, values_str = classify(line)
+
+            if kind == LINE_START:
+                if font_width is None and 'FONTBOUNDINGBOX' in record.items:
+                    font_bbox_w = record.items['FONTBOUNDINGBOX'][0]
+                    font_width = (font_bbox_w, bdf_width(font_bbox_w))
+                child = BdfRecord._from_start_line(line)
+                record.children.append(child)
+                stack.append(child)
+            elif kind == LINE_BITMAP:
+                try:
+                    bmp_width, bmp_height, *bmp_off = record.items['BBX']
+                except KeyError:
+                    raise SyntaxError(
+                        'Expected character BBX before BITMAP')
+                # Most (if not all) characters are as wide as the font
+                bmp_bdf_width = font_width[1] if font_width and font_width[0] == bmp_width else None
+                bitmap = BdfBitmap.parse_from(
+                    cursor, bmp_width, bmp_height, first_line=line, bdf_width=bmp_bdf_width)
+                if 'BITMAP' in record.items:
+                    raise SyntaxError(f'Repeated BITMAP in {record.type}')
+                record.items['BITMAP'] = bitmap
+            elif kind == LINE_KV:
+                # <KEY> <VALUE1> <VALUE2>...
+                if not values_str:
+                    # Either the file is malformed or `BdfBitmap.parse_from()` did not read all lines in the bitmap
+                    raise SyntaxError(f'Expected key-value pair but found {_text(line)}')
+                key = _text(key)
+                if key in record.items:
+                    raise SyntaxError(f'Repeated {key} in {record.type}')
+                record.items[key] = BdfProperty(values_str)
             else:
-                record.items[key] = item
+                # END<type> or EOF
+                expected_end_tag = 'END' + record.type
+                if line != expected_end_tag.encode():
+                    got = repr(_text(line)) if line else 'EOF'
+                    raise SyntaxError(f'Expected {expected_end_tag} but got {got}')
 
-        line = nextline(stream)
-        while line and not line.startswith('END'):
-            if line.startswith('START'):
-                record.children.append(
-                    BdfRecord.parse_from(stream, first_line=line))
-            else:
-                if line.startswith('BITMAP'):
+                if record.type == 'CHAR':
                     try:
-                        bmp_width, bmp_height, *bmp_off = record.items['BBX']
+                        record.encoding = record.items['ENCODING'][0]
                     except KeyError:
-                        raise SyntaxError(
-                            'Expected character BBX before BITMAP')
-                    bitmap = BdfBitmap.parse_from(
-                        stream, bmp_width, bmp_height, first_line=line)
-                    add_record_item('BITMAP', bitmap)
-                else:
-                    # TODO: If no space is present in `line` it is not a BITMAP line nor a key-value pair, so either:
-                    # - The file is malformed
-                    # - `BdfBitmap.parse_from()` did not read all lines in the bitmap
-                    # Should likely throw an exception in both cases
-                    # <KEY> <VALUE1> <VALUE2>...
-                    key, values_str = line.split(maxsplit=1)
-                    add_record_item(key, BdfProperty(values_str))
-
-            line = nextline(stream)
-
-        expected_end_tag = this_start_tag.replace('START', 'END')
-        if line != expected_end_tag:
-            got = repr(line) if line else 'EOF'
-            raise SyntaxError(f'Expected {expected_end_tag} but got {got}')
-
-        return record
+                        raise SyntaxError(f'Expected ENCODING in CHAR {" ".join(record.args)}')
+
+                stack.pop()
+
+        return root
 
     def __repr__(self) -> str:
         return f'BdfRecord({self.type})'
@@ -189,24 +272,56 @@ class BdfFont:
         self.copyright = getval(properties, 'COPYRIGHT', None)
         """Copyright info on the font."""
 
-        # Table for faster lookups
-        self._chars = {child.items['ENCODING'][0]: child
-                       for child in record.children if child.type == 'CHAR'}
-
-
-    def render_char(self, code: int) -> List[int]:
-        """Renders the character with the given code to a list of bytes.
+        # Table for faster lookups, indexed by `code - self._first_code`
+        # NOTE: Glyphs with a negative ENCODING are not mapped to any character
+        chars = [child for child in record.children
+                 if child.type == 'CHAR' and child.encoding >= 0]
+        self._first_code = min((char.encoding for char in chars), default=0)
+        last_code = max((char.encoding for char in chars), default=-1)
+        self._char_table = [None] * (last_code - self._first_code + 1)
+        """`(offset, length, has_font_bbox)` of each glyph in `_blob` (`None` for missing glyphs)."""
+
+        blob = bytearray()
+        for char in chars:
+            char_data = char.items['BITMAP'].data
+            char_bbox = char.items['BBX']
+            has_font_bbox = char_bbox[0] == self.bbox.w and char_bbox[1] == self.bbox.h
+            self._char_table[char.encoding - self._first_code] = (len(blob), len(char_data), has_font_bbox)
+            blob += char_data
+        self._blob = memoryview(bytes(blob))
+        """The bitmaps of all glyphs in the font, back-to-back."""
+        self._last = None
+        """`(code, bitmap)` of the last character successfully rendered."""
+
+
+    def render_char(self, code: int) -> memoryview:
+        """Renders the character with the given code to a buffer of bytes.
         (`n` bytes per row, left-to-right, top-to-bottom).
 
         Returns `None` if the character is missing from the font."""
 
-        char_record = self._chars.get(code, None)
-        if not char_record:
+        # Text often repeats the same character (e.g. whitespace)
+        last = self._last
+        if last is not None and last[0] == code:
+            return last[1]
+
+        index = code - self._first_code
+        if not (0 <= index < len(self._char_table)):
+            return None
+        char_entry = self._char_table[index]
+        if not char_entry:
             return None
 
-        char_bbox = char_record.items['BBX']
-        if char_bbox[0] != self.bbox.w or char_bbox[1] != self.bbox.h:
+        offset, length, has_font_bbox = char_entry
+        if not has_font_bbox:
             raise ValueError(
                 f'Character {code} has wrong BBX, font is not monospace!')
 
-        return char_record.items['BITMAP'].data
+        bitmap = self._blob[offset:offset + length]
+        self._last = (code, bitmap)
+        return bitmap
+
+
+    def render_chars(self, codes: Iterable[int]) -> List[memoryview]:
+        """Renders all characters with the given codes at once, as if via `render_char()`."""
+        return [self.render_char(code) for code in codes]
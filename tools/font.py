@@ -11,7 +11,7 @@ def row_width(width: int) -> int:
     """Calculates the width in bits of each row in the output font bitmaps from the actual witdth of a character in pixels."""
     # NOTE: Lines in BDF BITMAPs are always stored in multiples of 8 bits
     # (https://stackoverflow.com/a/37944252)
-    return -((-width) // 8) * 8
+    return (width + 7) & ~7  # (round up to a multiple of 8; `width` is never negative)
 
 BBox = namedtuple('BBox', 'w h ox oy')
 """The bounding box of a font's characters (width / height / origin X / origin Y)."""
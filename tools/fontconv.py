@@ -9,6 +9,7 @@ Released under the 3-clause BSD license (see LICENSE)
 
 import os
 import sys
+import io
 from argparse import ArgumentParser
 from typing import TextIO
 
@@ -19,8 +20,8 @@ from font import row_width
 def bdf_maker(args) -> 'Font':
     """Loads a BDF font given its path and expected width in pixels (`None` to ignore)."""
 
-    with open(args.infile, 'r') as infile:
-        record = bdf.BdfRecord.parse_from(infile, 'FONT')
+    with open(args.infile, 'rb') as infile:
+        record = bdf.BdfRecord.parse_from(bdf.LineCursor.from_stream(infile), 'FONT')
 
     if args.width and record.bbox.w != width:
         raise ValueError(f'Expected a font of width {width}px, but loaded one of width {record.bbox.w}px')
@@ -44,10 +45,25 @@ except ImportError:
 MAX_H_COL = 80
 """Maximum column when generating the .h, after which to wrap."""
 
+_HEX_BYTES = tuple(f'0x{byte:02X}, ' for byte in range(256))
+"""Maps each byte value to its C initializer (plus separator) in the .h."""
 
-def emit_mono_font_header(font: 'Font', first_ch: int, last_ch: int, stream: TextIO):
+_H_BYTES_PER_LINE = (MAX_H_COL - len('    ')) // len(_HEX_BYTES[0])
+"""Number of data bytes per (indented) line of the .h."""
+
+_ESCAPED_BYTES = tuple(f'\\x{byte:02X}' for byte in range(256))
+"""Maps each byte value to its escape sequence in a C string literal in the .h."""
+
+_H_ESCAPED_BYTES_PER_LINE = (MAX_H_COL - len('    ""')) // len(_ESCAPED_BYTES[0])
+"""Number of data bytes per (indented, quoted) line of the .h, when emitting string literals."""
+
+
+def emit_mono_font_header(font: 'Font', first_ch: int, last_ch: int, stream: TextIO, string_data: bool = False):
     """Outputs a weegfx C header file storing a character range (`start_ch`..`end_ch`, both inclusive)
-    of given font to `stream`. Only accepts monospace fonts!"""
+    of given font to `stream`. Only accepts monospace fonts!
+
+    If `string_data` is set, pixel data is emitted as (shorter, faster to compile) string literals
+    instead of a list of hex bytes."""
 
     def normname(name):
         return ''.join(ch if ch.isalnum() else '_' for ch in name)
@@ -61,10 +77,21 @@ def emit_mono_font_header(font: 'Font', first_ch: int, last_ch: int, stream: Tex
         raise ValueError(
             'Invalid character range (note: non-ASCII chars are not yet supported!)')
 
+    # Everything is buffered and written to `stream` at once
+    buf = io.StringIO()
+    write = buf.write
+
     h_varname = f'FONT_{normname(font.family.upper())}_{normname(font.weight.upper())}_{font.bbox.w}_{font.bbox.h}'
     h_guard = h_varname + '_H'
 
-    h_data_size = row_width(font.bbox.w) // 8 * font.bbox.h * (last_ch - first_ch + 1)
+    row_bytes = row_width(font.bbox.w) // 8
+    char_data_size = row_bytes * font.bbox.h
+    h_data_size = char_data_size * (last_ch - first_ch + 1)
+    if string_data:
+        h_data_size += 1  # (C++ requires room for the NUL terminator of the string literal)
+        byte_strs, bytes_per_line, line_start, line_end = _ESCAPED_BYTES, _H_ESCAPED_BYTES_PER_LINE, '\n    "', '"'
+    else:
+        byte_strs, bytes_per_line, line_start, line_end = _HEX_BYTES, _H_BYTES_PER_LINE, '\n    ', ''
     h_start = f"""// Autogenerated by weegfx/tools/fontconv.py
 // Only include this file ONCE in the codebase (every translation unit gets its copy of the font data!)
 //
@@ -76,30 +103,30 @@ def emit_mono_font_header(font: 'Font', first_ch: int, last_ch: int, stream: Tex
 #define {h_guard}
 
 static const WGFX_U8 {h_varname}_DATA[{h_data_size}] WGFX_RODATA = {{"""
-    print(h_start, file=stream)
-
-    empty_char_bitmap = [0x00] * (row_width(font.bbox.w) // 8 * font.bbox.h)
-
-    for ich in range(first_ch, last_ch + 1):
-        char_bitmap = font.render_char(ich)
+    write(h_start + '\n')
+
+    # Gather the pixel data of all characters first, then format all of it in one go
+    char_codes = range(first_ch, last_ch + 1)
+    data = bytearray(char_data_size * len(char_codes))  # (zero-filled, as missing characters should be)
+    missing_chars = set()
+    for ich, offset, char_bitmap in zip(char_codes, range(0, len(data), char_data_size),
+                                        font.render_chars(char_codes)):
         if char_bitmap is None:
             print(f'Character {ich} missing, zero-filling pixel data',
                   file=sys.stderr)
-            char_bitmap = empty_char_bitmap
+            missing_chars.add(ich)
+        else:
+            data[offset:offset + char_data_size] = char_bitmap
+    data_strs = list(map(byte_strs.__getitem__, data))
 
-        print(
-            f'    // {hexbyte(ich)} {repr(chr(ich))}{" (MISSING)" * (char_bitmap is empty_char_bitmap)}', end='', file=stream)
+    for ich, offset in zip(char_codes, range(0, len(data), char_data_size)):
+        write(f'    // {hexbyte(ich)} {repr(chr(ich))}{" (MISSING)" * (ich in missing_chars)}')
 
-        h_col = MAX_H_COL
-        for byte in char_bitmap:
-            byte_str = hexbyte(byte) + ', '
-            h_col += len(byte_str)
-            if h_col >= MAX_H_COL:
-                print('\n    ', file=stream, end='')
-                h_col = 0
-            print(byte_str, end='', file=stream)
+        char_strs = data_strs[offset:offset + char_data_size]
+        for i in range(0, char_data_size, bytes_per_line):
+            write(line_start + ''.join(char_strs[i:i + bytes_per_line]) + line_end)
 
-        print('', file=stream)
+        write('\n')
 
     h_end = f"""}};
 
@@ -107,11 +134,13 @@ static const WGFXmonoFont {h_varname} WGFX_RODATA = {{
     {font.bbox.w}, {font.bbox.h},
     {hexbyte(first_ch)}, {hexbyte(last_ch)},
     {h_varname}_DATA,
-    {row_width(font.bbox.w) // 8 * font.bbox.h}, // = {row_width(font.bbox.w) // 8} * {font.bbox.h}
+    {char_data_size}, // = {row_bytes} * {font.bbox.h}
 }};
 
 #endif // {h_guard}"""
-    print(h_end, file=stream)
+    write(h_end + '\n')
+
+    stream.write(buf.getvalue())
 
 
 if __name__ == '__main__':
@@ -129,6 +158,8 @@ if __name__ == '__main__':
                       help="First character of the range of characters to output (inclusive)")
     argp.add_argument('lastch', type=int,
                       help="Last character of the range of characters to output (inclusive)")
+    argp.add_argument('-S', '--string-data', action='store_true',
+                      help="Output pixel data as string literals instead of lists of bytes (smaller .h)")
 
     args = argp.parse_args()
 
@@ -144,4 +175,4 @@ if __name__ == '__main__':
     outfile = open(args.outfile, 'w') if args.outfile else sys.stdout
     with outfile:
         font = font_maker(args)
-        emit_mono_font_header(font, args.firstch, args.lastch, outfile)
+        emit_mono_font_header(font, args.firstch, args.lastch, outfile, string_data=args.string_data)
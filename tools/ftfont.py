@@ -8,32 +8,52 @@ Released under the 3-clause BSD license (see LICENSE)
 import os
 import sys
 import math
-from typing import Tuple, List
+import functools
+from typing import Tuple, List, Iterable
 import freetype as ft  # pip3 install freetype-py
 import numpy as np  # pip3 install numpy
 
 from font import row_width, BBox
 
-class FTFont:
-    """A TTF/OTF/other font loaded via Freetype."""
+@functools.lru_cache(maxsize=64)
+def _guesstimate_size(path: str, width: int, dpi: int, mtime: float, max_iters: int = 10) -> Tuple[int, int, int]:
+    """Iteratively change the size of the font at `path` until the horizontal advance of a 'M' bitmap (roughly)
+    matches with the desired one. Returns `(char size in 26.6 points, glyph width, line height)`.
+
+    The results are cached, as they only depend on the arguments (`mtime` is the modification time of
+    the font file, so that the cache is invalidated if it changes)."""
+    # TODO: Base sizes off a different character? - doing everything in em here
+
+    face = ft.Face(path)
+    # Initial estimate (in points) straight from the unscaled font metrics, so that few iterations are needed:
+    # `width [px] = max_advance_width [font units] * ft_size [pt] * dpi / 72 [px/inch] / units_per_EM [font units]`
+    ft_size = width * face.units_per_EM * 72 / (face.max_advance_width * dpi)
+    for i in range(max_iters):
+        char_size = int(math.ceil(ft_size * 64))
+        face.set_char_size(char_size, 0, dpi, 0)
+        glyph_width = face.size.max_advance // 64
+        if glyph_width == width:
+            break
+        ft_size *= width / glyph_width
+
+    line_height = (face.size.ascender - face.size.descender) // 64  # (scaled px height)
+    return (char_size, glyph_width, line_height)
 
 
-    def _guesstimate_size(self, width: int, dpi: int, max_iters: int = 10) -> Tuple[int, int]:
-        """Iteratively change `_font` size until the horizontal advance of a 'M' bitmap (roughly)
-        matches with the desired one."""
-        # TODO: Base sizes off a different character? - doing everything in em here
+def _glyph_bitmap(glyph: ft.GlyphSlot) -> np.ndarray:
+    """Returns the rendered bitmap of `glyph` as a `(rows, pitch)` array of bytes.
 
-        ft_size = 1.0
-        for i in range(max_iters):
-            self._font.set_char_size(int(math.ceil(ft_size * 64)), 0, dpi, 0)
-            glyph_width = self._font.size.max_advance // 64
-            if glyph_width == width:
-                break
-            ft_size *= width / glyph_width
+    The array is a view of Freetype's own buffer (`glyph.bitmap.buffer` would copy it to a list instead),
+    so it is only valid until the next glyph is loaded in the same face!"""
+    bitmap = glyph.bitmap
+    if bitmap.rows == 0 or bitmap.pitch == 0:
+        return np.zeros((bitmap.rows, bitmap.pitch), dtype=np.uint8)  # (the buffer may be NULL)
+    return np.ctypeslib.as_array(bitmap._FT_Bitmap.buffer, shape=(bitmap.rows, bitmap.pitch))
+
+
+class FTFont:
+    """A TTF/OTF/other font loaded via Freetype."""
 
-        line_height = (self._font.size.ascender - self._font.size.descender) // 64  # (scaled px height)
-        return (glyph_width, line_height)
-        
 
     def __init__(self, path: str, width: int, dpi: int):
         """Loads the font given its filepath, height (in pixels) and target DPI (for hinting)."""
@@ -44,9 +64,10 @@ class FTFont:
 
         # FIXME: This can potentially change the width desired by the user!
         #        A better approach would be to always estimate at a loss and add padding columns if needed
-        width, height = self._guesstimate_size(width, dpi)
+        char_size, width, height = _guesstimate_size(path, width, dpi, os.path.getmtime(path))
+        self._font.set_char_size(char_size, 0, dpi, 0)
         ox = 0  # TODO: Use horiBearingX of the capital M?
-        oy = self._font.descender // 64
+        oy = self._font.size.descender // 64
 
         self.bbox = BBox(w=width, h=height, ox=ox, oy=oy)
         """The font's bounding box (W / H / OX / OY)."""
@@ -61,20 +82,38 @@ class FTFont:
         """Copyright info on the font."""
 
 
-    def render_char(self, code: int) -> List[int]:
-        """Renders the character with the given code to a list of bytes.
+    def render_char(self, code: int) -> bytes:
+        """Renders the character with the given code to a buffer of bytes.
         (`n` bytes per row, left-to-right, top-to-bottom).
 
         Returns `None` if the character is missing from the font."""
 
+        out_bmp = np.zeros((self.bbox.h, row_width(self.bbox.w) // 8), dtype=np.uint8)
+        self._render_into(code, out_bmp)
+        return out_bmp.tobytes()
+
+
+    def render_chars(self, codes: Iterable[int]) -> List[bytes]:
+        """Renders all characters with the given codes at once, as if via `render_char()`."""
+
+        codes = list(codes)
+        out_bmps = np.zeros((len(codes), self.bbox.h, row_width(self.bbox.w) // 8), dtype=np.uint8)
+        for i, code in enumerate(codes):
+            self._render_into(code, out_bmps[i])
+        # (`bytes` iterate as plain ints, which is much faster than iterating over numpy arrays)
+        return [out_bmp.tobytes() for out_bmp in out_bmps]
+
+
+    def _render_into(self, code: int, out_bmp: np.ndarray):
+        """Renders the character with the given code to `out_bmp`, a zero-filled array
+        of `bbox.h` rows of `row_width(bbox.w) // 8` bytes."""
+
         self._font.load_char(code, ft.FT_LOAD_RENDER | ft.FT_LOAD_TARGET_MONO)  #< !!
         # FIXME: Return None if glyph could not be loaded properly
         glyph = self._font.glyph
 
         #assert glyph.metrics.horiAdvance // 64 == self.bbox.h
-        glyph_bmp_bytes = np.array(glyph.bitmap.buffer, dtype=np.uint8).reshape((glyph.bitmap.rows, glyph.bitmap.pitch))
-        glyph_bmp = np.unpackbits(glyph_bmp_bytes, axis=1)
-        out_bmp = np.zeros((self.bbox.h, row_width(self.bbox.w)), dtype=np.uint8)
+        glyph_bmp_bytes = _glyph_bitmap(glyph)
 
         sy = self.bbox.h + self.bbox.oy - glyph.bitmap_top  # quad bottom -> baseline -> glyph top
         ey = sy + glyph.bitmap.rows
@@ -88,8 +127,26 @@ class FTFont:
         if ey > self.bbox.h:
             print(f"{chr(code)}: clipped {ey - self.bbox.h}px bottom", file=sys.stderr)
             ey = self.bbox.h
+        if sy < 0:
+            print(f"{chr(code)}: clipped {-sy}px top", file=sys.stderr)
+            glyph_bmp_bytes = glyph_bmp_bytes[-sy:]
+            sy = 0
         #print('oy', self.bbox.oy, 'sy', sy, 'ey', ey, 'sx', sx, 'ex', ex)
 
-        out_bmp[sy:ey, sx:ex] = glyph_bmp[:(ey - sy), :(ex - sx)]
+        if sx >= 0 and sx % 8 == 0 and ((ex - sx) % 8 == 0 or ex == sx + glyph.bitmap.width):
+            # Byte-aligned glyph: copy its packed rows as-is, no need to unpack them to single pixels
+            # NOTE: Freetype zero-fills the unused bits at the end of each row
+            sx_byte = sx // 8
+            n_bytes = row_width(ex - sx) // 8
+            out_bmp[sy:ey, sx_byte:(sx_byte + n_bytes)] = glyph_bmp_bytes[:(ey - sy), :n_bytes]
+            return
 
-        return np.packbits(out_bmp.ravel())
+        glyph_bmp = np.unpackbits(glyph_bmp_bytes, axis=1)
+        if sx < 0:
+            print(f"{chr(code)}: clipped {-sx}px left", file=sys.stderr)
+            glyph_bmp = glyph_bmp[:, -sx:]
+            sx = 0
+        out_bits = np.zeros((self.bbox.h, row_width(self.bbox.w)), dtype=np.uint8)
+        out_bits[sy:ey, sx:ex] = glyph_bmp[:(ey - sy), :(ex - sx)]
+
+        out_bmp[:] = np.packbits(out_bits, axis=1)